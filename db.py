@@ -6,88 +6,243 @@ import numpy as np
 import sqlite3
 from tqdm import tqdm
 import collections
-import pandas as pd
-db_conn = sqlite3.connect("league.db")
+import functools
+
+
+def tune_connection(conn):
+    """
+    Applies the standard performance PRAGMAs (WAL journal, relaxed fsync,
+    bigger page cache, mmap) to a sqlite3 connection and returns it.
+    """
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA cache_size=-262144")     # 256MB
+    conn.execute("PRAGMA mmap_size=1073741824")   # 1GB
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA busy_timeout=60000")
+    return conn
+
+
+# One shared read connection for the whole module. db.py never writes, and
+# WAL mode lets any number of readers proceed concurrently, so handing the
+# same connection (with its warm page and statement caches) to every helper
+# beats re-opening the file per call.
+db_conn = tune_connection(sqlite3.connect("league.db",
+    check_same_thread=False, cached_statements=1024))
+
+# SQL lives in module-level constants so sqlite3's per-connection statement
+# cache (keyed on the exact string) always hits.
+_Q_CHAMP_IDS = "SELECT distinct championId FROM Champions"
+_Q_WINNERS = "SELECT matchId, winner FROM Matches"
+_Q_PARTICIPANTS = ("SELECT matchId, summonerName, championId, teamId, "
+    "teamPosition FROM Participants")
+_Q_MASTERIES = ("SELECT summonerName, championId, championPoints "
+    "FROM ChampionMastery")
 # TEMPLATES
 class MatchInfo:
 
+    __slots__ = ("winner", "players")
+
     def __init__(self):
         self.winner = 0
         self.players = []
 
 class PlayerInfo:
 
+    __slots__ = ("champion_id", "masteries", "team_position", "team_id",
+                 "win_rate")
+
     def __init__(self):
         self.champion_id = 0
-        self.masteries = {}
+        # Filled in with a shared read-only (161, 2) int32 view by
+        # db_matchinfo_list; no point allocating a placeholder per instance.
+        self.masteries = None
         self.team_position = None
         self.team_id = None
-        self.win_rate = []
+        self.win_rate = None
 
 
+@functools.lru_cache(maxsize=1)
 def win_rate():
-    sql3 = ("SELECT ch.championName, ch.difficulty, COUNT(m.winner) as games_won_by_champ FROM Champions as ch JOIN Participants as p on ch.championId = p.championId JOIN Matches as m on p.matchId = m.matchId WHERE m.winner = p.teamId GROUP BY ch.championName ORDER BY championName ASC")
-    df1 = pd.read_sql(sql3, con = db_conn)
-    # print(df)
-    sql4 = "select Champions.championName, count(*) as total from Participants join Champions on Participants.championId == Champions.championId join Matches on Matches.matchId == Participants.matchId group by championName Order BY championName"
-    df2 = pd.read_sql(sql4, con = db_conn)
-    # print(df2)
-    dataframe = pd.DataFrame().assign(ChampionName=df1['championName'], gamesWon=df1['games_won_by_champ'], difficulty=df1["difficulty"], total=df2['total'])
-    dataframe['percentage'] = np.nan
-    dataframe['percentage'] = dataframe['gamesWon']/dataframe['total'] * 100
-    dataframe['percentage'] = dataframe['percentage'].apply(lambda x: round(x, 2))
-    return dataframe
-
-
-# TODO: kill this with fire
-def db_matchinfo_list(limit=None):
-
-    conn = sqlite3.connect("league.db")
-    all_matches = conn.execute("""SELECT distinct matchId FROM
-        Participants;""").fetchall()
-
-    res = []
-    all_matches = all_matches if not limit else all_matches[:limit]
-    all_champ_ids = set([i[0] for i in conn.execute("SELECT distinct championId FROM Champions;").fetchall()])
+    """
+    Returns per-champion win rates as a dict of parallel numpy arrays
+    (championName, difficulty, gamesWon, total, percentage), ordered by
+    champion name. The aggregation happens inside SQLite, so memory use is
+    one row per champion rather than the full three-table join.
+    """
+    rows = db_conn.execute(
+        """
+        SELECT ch.championName, ch.difficulty,
+               SUM(CASE WHEN m.winner = p.teamId THEN 1 ELSE 0 END) AS won,
+               COUNT(*) AS total
+        FROM Champions AS ch
+        JOIN Participants AS p ON ch.championId = p.championId
+        JOIN Matches AS m ON p.matchId = m.matchId
+        GROUP BY ch.championName
+        ORDER BY ch.championName ASC
+        """).fetchall()
+
+    if rows:
+        names, difficulty, won, total = zip(*rows)
+    else:
+        # A fresh database has no matches yet; hand back the same dict shape
+        # with zero-length arrays so callers degrade to empty output instead
+        # of crashing on the unpack.
+        names, difficulty, won, total = (), (), (), ()
+
+    won = np.array(won, dtype=np.int64)
+    total = np.array(total, dtype=np.int64)
+
+    result = {
+        "championName": np.array(names, dtype=str),
+        "difficulty": np.array(difficulty, dtype=np.int32),
+        "gamesWon": won,
+        "total": total,
+        "percentage": np.round(won / total * 100, 2),
+    }
+
+    for arr in result.values():
+        arr.setflags(write=False)
+
+    return result
+
+
+def db_matchinfo_arrays(limit=None):
+    """
+    Loads every valid match as a dict of parallel numpy arrays instead of
+    per-match Python objects:
+
+        "winner":         uint8  (N,)           100 or 200
+        "champion_ids":   int16  (N, 10)
+        "team_ids":       uint8  (N, 10)        100 or 200
+        "team_positions": str    (N, 10)        TOP/JUNGLE/MIDDLE/BOTTOM/UTILITY
+        "masteries":      int32  (N, 10, 161)   mastery points per champion
+        "champ_ids":      int32  (161,)         column order of "masteries"
+
+    A match is valid if it has a recorded winner, exactly 10 participants,
+    and a team position for every participant.
+    """
+
+    conn = db_conn
+
+    champ_ids_sorted = np.array(sorted(row[0] for row in
+        conn.execute(_Q_CHAMP_IDS)),
+        dtype=np.int32)
+    champ_index = {cid: i for i, cid in enumerate(champ_ids_sorted)}
+    n_champs = len(champ_ids_sorted)
+
+    # Instead of issuing one query per match (and ten more per match for the
+    # masteries), pull each table down in a single scan and group the rows in
+    # Python. Iterating the cursors directly keeps us from materializing the
+    # intermediate row lists.
+    winners = dict(conn.execute(_Q_WINNERS))
+
+    parts_by_match = collections.defaultdict(list)
+    for row in conn.execute(_Q_PARTICIPANTS):
+        parts_by_match[row[0]].append(row[1:])
+
+    # One mastery-points row per unique summoner, indexed by champion position
+    # in champ_ids_sorted. Collect (summoner, champion, points) index triples
+    # first and fill the whole matrix with a single fancy-index scatter
+    # instead of assigning one numpy scalar per database row.
+    summoner_index = {}
+    sum_idx = []
+    chmp_idx = []
+    pts = []
+
+    for summoner_name, champ_id, points in conn.execute(_Q_MASTERIES):
+        idx = champ_index.get(champ_id)
+        if idx is None:
+            continue
 
-    for match_id, in tqdm(all_matches):
+        sum_idx.append(summoner_index.setdefault(summoner_name,
+            len(summoner_index)))
+        chmp_idx.append(idx)
+        pts.append(points)
+
+    points_matrix = np.zeros((len(summoner_index) + 1, n_champs),
+        dtype=np.int32)
+    points_matrix[sum_idx, chmp_idx] = pts
+
+    # The extra all-zero row stands in for summoners with no mastery data.
+    no_masteries_idx = len(summoner_index)
+
+    match_ids = list(parts_by_match.keys())
+    match_ids = match_ids if not limit else match_ids[:limit]
+
+    # Sanity check, same criteria the per-object loader used:
+    selected = [match_id for match_id in match_ids
+        if match_id in winners
+        and len(parts_by_match[match_id]) == 10
+        and all(len(p[3]) > 0 for p in parts_by_match[match_id])]
+
+    n = len(selected)
+    arrays = {
+        "winner": np.zeros(n, dtype=np.uint8),
+        "champion_ids": np.zeros((n, 10), dtype=np.int16),
+        "team_ids": np.zeros((n, 10), dtype=np.uint8),
+        "team_positions": np.zeros((n, 10), dtype="U7"),
+        "masteries": np.zeros((n, 10, n_champs), dtype=np.int32),
+        "champ_ids": champ_ids_sorted,
+    }
+
+    for i, match_id in enumerate(tqdm(selected)):
+        arrays["winner"][i] = winners[match_id]
+
+        for j, (summoner_name, champion_id, team_id, team_position) \
+                in enumerate(parts_by_match[match_id]):
+            arrays["champion_ids"][i, j] = champion_id
+            arrays["team_ids"][i, j] = team_id
+            arrays["team_positions"][i, j] = team_position
+            arrays["masteries"][i, j] = points_matrix[
+                summoner_index.get(summoner_name, no_masteries_idx)]
+
+    return arrays
+
+
+def db_matchinfo_iter(limit=None):
+    """
+    Yields one MatchInfo at a time, rebuilt from slices of the bulk arrays.
+    The arrays themselves are loaded up front (that cost is unavoidable),
+    but callers that stream matches into a preallocated tensor never hold
+    the full MatchInfo/PlayerInfo object graph in memory at once.
+    """
+
+    arrays = db_matchinfo_arrays(limit)
+    n, n_players, n_champs = arrays["masteries"].shape
+
+    # (N, 10, 161, 2): champion IDs in column 0, points in column 1, matching
+    # the p.masteries[i][0] / p.masteries[i][1] layout consumers expect.
+    combined = np.zeros((n, n_players, n_champs, 2), dtype=np.int32)
+    combined[..., 0] = arrays["champ_ids"]
+    combined[..., 1] = arrays["masteries"]
+    combined.setflags(write=False)
+
+    # win_rate() scans the whole database, so compute it once up front and
+    # hand every player the same read-only array.
+    win_rate_cache = win_rate()["percentage"]
+
+    for i in range(n):
         m = MatchInfo()
-        m.winner = conn.execute("""SELECT winner FROM Matches WHERE
-            Matches.matchId == ?""", [match_id]).fetchone()[0]
-
-        players = conn.execute("""SELECT summonerName, championId, teamId,
-            teamPosition FROM Participants WHERE Participants.matchId == ?""",
-            [match_id]).fetchall()
+        m.winner = int(arrays["winner"][i])
 
-        for summoner_name, champion_id, team_id, team_position in players:
+        for j in range(n_players):
             p = PlayerInfo()
-            p.champion_id = champion_id
-            p.team_id = team_id
-            p.team_position = team_position
-
-            masteries = {champ_id: score for champ_id, score in conn.execute(
-                """SELECT championId, championPoints
-                   FROM ChampionMastery
-                   WHERE ChampionMastery.summonerName == ?
-                   ORDER BY championId ASC""",
-                   [summoner_name]).fetchall()}
-            
-
-            all_masteries = {champ_id: 0 for champ_id in all_champ_ids}
-
-            for champion_mastery_id, mastery_score in masteries.items():
-                all_masteries[champion_mastery_id] = mastery_score
-            
-            p.masteries = sorted(list(all_masteries.items()), key=lambda x:x[0])
-            p.win_rate = 0 #win_rate()["percentage"]
+            p.champion_id = int(arrays["champion_ids"][i, j])
+            p.team_id = int(arrays["team_ids"][i, j])
+            p.team_position = str(arrays["team_positions"][i, j])
+            p.masteries = combined[i, j]
+            p.win_rate = win_rate_cache
             m.players.append(p)
 
-        # Sanity check:
-        if (len(m.players) != 10 
-            or any([len(p.masteries) != 161 for p in m.players])
-            or any([len(p.team_position) == 0 for p in m.players])):
-            continue
-        
-        res.append(m)
-    
-    return res
\ No newline at end of file
+        yield m
+
+
+# TODO: kill this with fire
+def db_matchinfo_list(limit=None):
+    """
+    Compatibility wrapper that materializes `db_matchinfo_iter()` into a
+    list. Prefer the iterator for anything that streams.
+    """
+
+    return list(db_matchinfo_iter(limit))
\ No newline at end of file
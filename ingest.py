@@ -8,33 +8,92 @@ key. Each thread performs a breadth-first search over the player graph by adding
 each player's past match IDs to a queue. Only matched games on Summoner's Rift
 are considered, and the rest are skipped.
 
+Threads are deliberate: each worker spends almost all of its time blocked on
+rate-limited HTTP (during which the GIL is released), so processes would buy
+no throughput while costing us the shared SQLite connection semantics the
+WorkQueue/SeenMatches claims rely on.
+
 An important goal of this module is to continue running each thread for as long
 as possible. Because of this, many exceptions, like KeyErrors, IndexErrors, and
 certain kinds of HTTPErrors are ignored (or recovered from) where they can be.
 """
 
-import collections
+import concurrent.futures
+import itertools
+import json
 import logging
+import operator
 import os
 import random
 import sqlite3
 import threading
 import time
 import traceback
+import zlib
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 CHAMPION_DATA_URL = "https://ddragon.leagueoflegends.com/cdn/12.19.1/data/en_US/champion.json"
-DELAY = 120 / 100 # Limit is 100 requests every 2 minutes, or 20 requests in 1
-                  # second
 REQUEST_RETRY_COUNT = 5 # How many times we will re-send a request before giving
                         # up
+REQUEST_TIMEOUT = 10 # Seconds before an unresponsive request is abandoned,
+                     # so a dead socket can't stall a worker thread forever
 
 class SummonerNotFoundException(Exception):
     pass
 
 
+class TokenBucket:
+    """
+    Thread-safe token bucket pacing requests against one of Riot's rate
+    limits. acquire() blocks until a token is available. Unlike a fixed
+    per-request sleep, the bucket lets a thread burst through its backlog
+    right after startup or a long database stall and only slows down once
+    the budget is actually spent.
+    """
+
+    def __init__(self, capacity=100, period=120.0):
+        self.capacity = capacity
+        self.refill_rate = capacity / period  # tokens per second
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens
+                    + (now - self.last_refill) * self.refill_rate)
+                self.last_refill = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.refill_rate
+
+            time.sleep(wait)
+
+
+def tune_connection(conn):
+    """
+    Sets up a sqlite3 connection for write-heavy ingest: WAL journaling so
+    readers don't block the writer, synchronous=NORMAL to avoid an fsync per
+    statement, and a generous cache/mmap budget.
+    """
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA cache_size=-262144")     # 256MB
+    conn.execute("PRAGMA mmap_size=1073741824")   # 1GB
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA busy_timeout=60000")
+    return conn
+
+
 def get_keys_from_file(file_name):
     """
     Returns a list of all Riot API keys from a text file.
@@ -44,26 +103,62 @@ def get_keys_from_file(file_name):
         return [key.strip() for key in file.readlines() if key[:5] == "RGAPI"]
 
 
-def get_with_retry(url):
+def make_session(api_key):
+    """
+    Builds a requests.Session for one API key. The session keeps pooled
+    keep-alive connections to both Riot hosts (so we pay the TCP/TLS
+    handshake once, not per request) and automatically attaches the API key
+    to every call. Sessions are not thread-safe, so each worker thread gets
+    its own.
+    """
+    session = requests.Session()
+    session.params = {"api_key": api_key}
+
+    # Rate limits are per key and each key owns one session, so the buckets
+    # live on the session where every fetch helper can reach them. Riot
+    # enforces two windows: 100 requests / 2 minutes and 20 requests / 1
+    # second; a request must clear both.
+    session.rate_limiter = TokenBucket()
+    session.burst_limiter = TokenBucket(capacity=20, period=1.0)
+
+    # Retry only connection-level failures (refused/reset/read timeouts)
+    # at the adapter. Status-based retries live in get_with_retry's manual
+    # loop, where each attempt goes back through the token buckets; letting
+    # urllib3 retry on status would re-send without spending quota tokens.
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8,
+        max_retries=Retry(total=3, backoff_factor=0.5))
+
+    session.mount("https://na1.api.riotgames.com", adapter)
+    session.mount("https://americas.api.riotgames.com", adapter)
+
+    return session
+
+
+def get_with_retry(session, url):
     retry_attempts = 0
-    req = requests.get(url)
-    time.sleep(DELAY)
+
+    session.rate_limiter.acquire()
+    session.burst_limiter.acquire()
+    req = session.get(url, timeout=REQUEST_TIMEOUT)
 
     if req.status_code == 403:
         logging.error("Request for %s received status code 403, shutting down", url)
         exit(1)
 
-    while req.status_code in (429, 500, 503) and retry_attempts < REQUEST_RETRY_COUNT:
+    while (req.status_code in (429, 500, 502, 503, 504)
+            and retry_attempts < REQUEST_RETRY_COUNT):
         logging.warning("Received status code %d for %s, retrying",
             req.status_code, url)
         time.sleep(5)
-        req = requests.get(url)
+        session.rate_limiter.acquire()
+        session.burst_limiter.acquire()
+        req = session.get(url, timeout=REQUEST_TIMEOUT)
         retry_attempts += 1
 
     return req
 
 
-def get_player_info_by_summoner_name(summoner_name, api_key):
+def get_player_info_by_summoner_name(summoner_name, session):
     """
     Returns a player's account information given a summoner name.
 
@@ -73,20 +168,26 @@ def get_player_info_by_summoner_name(summoner_name, api_key):
 
     url = "https://na1.api.riotgames.com"
     endpoint = "lol/summoner/v4/summoners/by-name"
-    full_url = f"{url}/{endpoint}/{summoner_name}?api_key={api_key}"
-    req = get_with_retry(full_url)
+    req = get_with_retry(session, f"{url}/{endpoint}/{summoner_name}")
 
-    if req.status_code == 404 and "summoner not found" in req.json()["status"]["message"]:
-        raise SummonerNotFoundException(summoner_name);
+    if req.status_code == 404:
+        # Parse the error body once; requests re-decodes the JSON on every
+        # .json() call.
+        body = req.json()
+        if "summoner not found" in body["status"]["message"]:
+            raise SummonerNotFoundException(summoner_name)
 
     req.raise_for_status()
 
     return req.json()
 
 
-def get_matches_by_puuid(puuid, api_key):
+def get_matches_by_puuid(puuid, session, queue=420, match_type="ranked"):
     """
-    Returns a player's most recent 100 matches given the player's PUUID.
+    Returns a player's most recent 100 matches given the player's PUUID. By
+    default only ranked Solo/Duo Summoner's Rift games (queue 420) are
+    requested; the endpoint filters server-side, so unwanted matches never
+    cost us a fetch.
 
     Reference:
     https://developer.riotgames.com/apis#match-v5/GET_getMatchIdsByPUUID
@@ -94,13 +195,15 @@ def get_matches_by_puuid(puuid, api_key):
 
     url = "https://americas.api.riotgames.com"
     endpoint = "lol/match/v5/matches/by-puuid"
-    req = get_with_retry(f"{url}/{endpoint}/{puuid}/ids?start=0&count=100&api_key={api_key}")
+    req = get_with_retry(session,
+        f"{url}/{endpoint}/{puuid}/ids"
+        f"?start=0&count=100&queue={queue}&type={match_type}")
     req.raise_for_status()
 
     return req.json()
 
 
-def get_match_by_match_id(match_id, api_key):
+def get_match_by_match_id(match_id, session):
     """
     Returns detailed information about a match given a match ID.
 
@@ -110,13 +213,13 @@ def get_match_by_match_id(match_id, api_key):
 
     url = "https://americas.api.riotgames.com"
     endpoint = "lol/match/v5/matches"
-    req = get_with_retry(f"{url}/{endpoint}/{match_id}?api_key={api_key}")
+    req = get_with_retry(session, f"{url}/{endpoint}/{match_id}")
     req.raise_for_status()
 
     return req.json()
 
 
-def get_champion_mastery(encrypted_summoner_id, api_key):
+def get_champion_mastery(encrypted_summoner_id, session):
     """
     Returns champion mastery information for a summoner given an encrypted
     summoner ID.
@@ -127,46 +230,104 @@ def get_champion_mastery(encrypted_summoner_id, api_key):
 
     url = "https://na1.api.riotgames.com"
     endpoint = "lol/champion-mastery/v4/champion-masteries/by-summoner"
-    req = get_with_retry(f"{url}/{endpoint}/{encrypted_summoner_id}?api_key={api_key}")
+    req = get_with_retry(session, f"{url}/{endpoint}/{encrypted_summoner_id}")
     req.raise_for_status()
 
     return req.json()
 
 
-def get_champion_data():
+# Champions columns in schema order and, below, how to pull each one out of
+# a Data Dragon champion entry. Building positionally-ordered tuples straight
+# off the parsed JSON skips the per-champion dict (and the per-run key sort)
+# the old path went through.
+_CHAMPION_COLS = (
+    "armor", "armorperlevel", "attack", "attackdamage",
+    "attackdamageperlevel", "attackrange", "attackspeed",
+    "attackspeedperlevel", "championId", "championName", "crit",
+    "critperlevel", "defense", "difficulty", "hp", "hpperlevel", "hpregen",
+    "hpregenperlevel", "magic", "movespeed", "mp", "mpperlevel", "mpregen",
+    "mpregenperlevel", "spellblock", "spellblockperlevel", "tags")
+
+_CHAMPION_INSERT_SQL = "INSERT INTO Champions ({}) VALUES ({})".format(
+    ",".join(_CHAMPION_COLS), ",".join(["?"] * len(_CHAMPION_COLS)))
+
+_CHAMPION_EXTRACTORS = {
+    "championName": lambda v: v["id"],
+    "championId": lambda v: int(v["key"]),
+    "attack": lambda v: v["info"]["attack"],
+    "defense": lambda v: v["info"]["defense"],
+    "magic": lambda v: v["info"]["magic"],
+    "difficulty": lambda v: v["info"]["difficulty"],
+    "tags": lambda v: ",".join(v["tags"]),
+}
+
+# Everything else is a flat stat.
+for _col in _CHAMPION_COLS:
+    _CHAMPION_EXTRACTORS.setdefault(_col, lambda v, c=_col: v["stats"][c])
+
+
+CHAMPION_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache",
+    "teamcomp")
+
+
+def _fetch_champion_json():
     """
-    Gets relevant data about all current champions in League of Legends from a
-    Riot endpoint and returns the result as a list of dictionaries, one dict per
-    champion.
+    Returns the parsed Data Dragon champion blob. The response is cached on
+    disk and revalidated with If-None-Match, so while the upstream blob is
+    unchanged each call costs a 304 with no body instead of a ~300KB
+    download. Any cache trouble just falls back to a plain fetch.
     """
+    cache_path = os.path.join(CHAMPION_CACHE_DIR, "champion.json")
+    etag_path = cache_path + ".etag"
 
-    req = requests.get(CHAMPION_DATA_URL)
-    result = []
-    tags = set()
+    headers = {}
+
+    if os.path.exists(cache_path) and os.path.exists(etag_path):
+        with open(etag_path, encoding="utf-8") as file:
+            headers["If-None-Match"] = file.read().strip()
+
+    req = requests.get(CHAMPION_DATA_URL, headers=headers,
+        timeout=REQUEST_TIMEOUT)
+
+    if req.status_code == 304:
+        with open(cache_path, encoding="utf-8") as file:
+            return json.load(file)
+
+    req.raise_for_status()
+
+    try:
+        os.makedirs(CHAMPION_CACHE_DIR, exist_ok=True)
 
-    # Collect all tags:
-    for data in req.json()["data"].values():
-        for tag in data["tags"]:
-            tags.add(tag)
+        with open(cache_path, "wb") as file:
+            file.write(req.content)
 
-        champ_data = {
-            "championName": data["id"],
-            "championId": int(data["key"]),
-            "attack": data["info"]["attack"],
-            "defense": data["info"]["defense"],
-            "magic": data["info"]["magic"],
-            "difficulty": data["info"]["difficulty"],
-            "tags": ",".join(data["tags"])
-        }
+        if "ETag" in req.headers:
+            with open(etag_path, "w", encoding="utf-8") as file:
+                file.write(req.headers["ETag"])
+    except OSError as err:
+        logging.warning("Could not cache champion data: %s", str(err))
 
-        for stat, value in data["stats"].items():
-            champ_data[stat] = value
+    return req.json()
 
-        result.append(champ_data)
+
+def get_champion_data():
+    """
+    Gets relevant data about all current champions in League of Legends from a
+    Riot endpoint and returns the result as a list of tuples ordered by
+    _CHAMPION_COLS, one tuple per champion.
+    """
+
+    rows = []
+    tags = set()
+
+    for data in _fetch_champion_json()["data"].values():
+        tags.update(data["tags"])
+        rows.append(tuple(_CHAMPION_EXTRACTORS[col](data)
+            for col in _CHAMPION_COLS))
 
     # Should be {"Assassin", "Marksman", "Support", "Fighter", "Mage", "Tank"}
     assert len(tags) == 6
-    return result
+    return rows
 
 
 def maybe_init_db_from_schema(db_name="league.db", schema="schema.sql"):
@@ -179,27 +340,14 @@ def maybe_init_db_from_schema(db_name="league.db", schema="schema.sql"):
 
     try:
         logging.info("%s does not exist, initializing schema", db_name)
-        conn = sqlite3.connect(db_name)
+        conn = tune_connection(sqlite3.connect(db_name, cached_statements=256))
 
         with open(schema, encoding="utf-8") as file:
             lines = file.read()
             conn.executescript(lines)
 
-        for champ_data in get_champion_data():
-            # values in champ_data in alphabetical order
-            values = [champ_data[name]
-                for name in sorted(list(champ_data.keys()))]
-
-            conn.execute(
-                f"""
-                INSERT INTO Champions VALUES ({
-                    ",".join(["?"] * len(champ_data))
-                })
-                """,
-                tuple(values)
-            )
-
-        conn.commit()
+        with conn:
+            conn.executemany(_CHAMPION_INSERT_SQL, get_champion_data())
 
     except Exception as ex:
         traceback.print_exception(type(ex), ex, ex.__traceback__)
@@ -208,204 +356,400 @@ def maybe_init_db_from_schema(db_name="league.db", schema="schema.sql"):
         os.remove(db_name)
 
 
-def process_match(data, conn, seen_masteries, api_key):
+def reindex(db_name="league.db"):
     """
-    Given match data as retrieved by `get_match_by_id()`, extracts relevant data
-    fields and commits them to the database using `conn` (a sqlite3 connection).
+    Creates the indexes backing the hot lookups (mastery-by-summoner,
+    participants-by-match) if they are missing and refreshes the query
+    planner's statistics. Safe to run on an already-populated database.
+    """
+    conn = tune_connection(sqlite3.connect(db_name, cached_statements=256))
+
+    # Databases initialized from the old schema carry a *non-unique*
+    # championMasteryIdx, which CREATE UNIQUE INDEX IF NOT EXISTS below
+    # silently leaves in place -- and without uniqueness the OR IGNORE
+    # mastery inserts happily duplicate rows. Drop the legacy index,
+    # collapse any duplicates it let in, and let the create rebuild it
+    # UNIQUE.
+    legacy = conn.execute(
+        """SELECT sql FROM sqlite_master
+           WHERE type = 'index' AND name = 'championMasteryIdx'""").fetchone()
+
+    if legacy is not None and "UNIQUE" not in (legacy[0] or "").upper():
+        with conn:
+            conn.execute("DROP INDEX championMasteryIdx")
+            conn.execute("""DELETE FROM ChampionMastery WHERE rowid NOT IN (
+                SELECT MIN(rowid) FROM ChampionMastery
+                GROUP BY summonerName, championId)""")
+
+    with conn:
+        conn.execute("""CREATE UNIQUE INDEX IF NOT EXISTS championMasteryIdx
+            ON ChampionMastery(summonerName, championId)""")
+        conn.execute("""CREATE INDEX IF NOT EXISTS participantIdx
+            ON Participants(summonerName, matchId)""")
+        conn.execute("""CREATE INDEX IF NOT EXISTS participantMatchIdx
+            ON Participants(matchId)""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS SeenMatches (
+            matchId TEXT PRIMARY KEY)""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS WorkQueue (
+            matchId TEXT PRIMARY KEY,
+            claimed_by INTEGER DEFAULT NULL,
+            claimed_at INTEGER DEFAULT NULL)""")
+
+    # Databases from before raw payloads were kept need the extra column.
+    if "rawJson" not in [col[1] for col in
+            conn.execute("PRAGMA table_info('Matches')")]:
+        with conn:
+            conn.execute("ALTER TABLE Matches ADD COLUMN rawJson BLOB")
+
+    conn.execute("ANALYZE")
+    conn.close()
+
+
+_MASTERY_INSERT_SQL = "INSERT OR IGNORE INTO ChampionMastery VALUES(?,?,?,?)"
+
+_WQ_ENQUEUE_SQL = "INSERT OR IGNORE INTO WorkQueue(matchId) VALUES(?)"
+
+# Claiming a row and reading its matchId happen in one statement, so two
+# threads can never claim the same match.
+_WQ_CLAIM_SQL = """
+    UPDATE WorkQueue SET claimed_by = ?, claimed_at = ?
+    WHERE matchId = (SELECT matchId FROM WorkQueue
+                     WHERE claimed_by IS NULL LIMIT 1)
+    RETURNING matchId
     """
 
-    now = time.time()
+_WQ_DELETE_SQL = "DELETE FROM WorkQueue WHERE matchId = ?"
 
-    info = data["info"]
-    meta = data["metadata"]
-    winner = 100 if info["teams"][0]["win"] else 200
-
-    # Insert information about the match:
-    conn.execute(
-        """
-        INSERT INTO Matches
-        (gameVersion, matchId, gameCreation, gameDuration, gameId, winner)
-        VALUES(?, ?, ?, ?, ?, ?)
-        """,
-        [info["gameVersion"], meta["matchId"], info["gameCreation"],
-        info["gameDuration"], info["gameId"], winner])
-    conn.commit()
-
-    # This returns a list of tuples that looks something like this:
-    # [(0, 'assists', 'INTEGER', 0, None, 0),
-    #  (1, 'baronKills', 'INTEGER', 0, None, 0),
-    #  (2, 'championId', 'INTEGER', 0, None, 0),
-    #  ... ]
-    # NOTE: Hacky! But allows us to use the schema to *mostly* determine which
-    # fields we want to grab from the JSON.
-    fields = [field for field in
-        conn.execute("PRAGMA table_info('Participants')").fetchall()
-        if field [1] != "matchId"]
+# Shared progress counter for the "Processed N matches" log line. next() on a
+# count iterator is atomic under the GIL, so workers share it with no lock.
+_progress = itertools.count(1)
 
-    for participant in info["participants"]:
-        values = []
+_MATCH_INSERT_SQL = """
+    INSERT INTO Matches
+    (gameVersion, matchId, gameCreation, gameDuration, gameId, winner, rawJson)
+    VALUES(?, ?, ?, ?, ?, ?, ?)
+    """
 
-        for field in sorted(fields, key=lambda x: x[1]):
-            values.append(participant[field[1]])
-        values.append(meta["matchId"])
+# Participant column names (minus matchId) in insertion order, and the
+# matching INSERT statement. Derived from the schema once on first use; the
+# schema never changes at runtime, so there is no reason to re-run the PRAGMA
+# and re-sort per match.
+_PARTICIPANT_FIELDS = None
+_PARTICIPANT_INSERT_SQL = None
+_PARTICIPANT_GETTER = None
 
-        conn.execute(
-            f"""
-            INSERT INTO Participants VALUES({
-                ",".join(["?"] * (len(fields) + 1))
-            })
-            """,
-            values)
-        conn.commit()
 
-        # Get each participant's champion mastery info (if we don't have it
-        # already)
-        if participant["summonerName"] not in seen_masteries:
-            mastery_list = get_champion_mastery(participant["summonerId"],
-                api_key)
+def _participant_fields(conn):
+    global _PARTICIPANT_FIELDS, _PARTICIPANT_INSERT_SQL, _PARTICIPANT_GETTER
 
-            for mastery in mastery_list:
-                conn.execute("INSERT INTO ChampionMastery VALUES(?,?,?,?)",
-                    (mastery["championId"], mastery["championLevel"],
-                    mastery["championPoints"], participant["summonerName"]))
-            seen_masteries.add(participant["summonerName"])
+    if _PARTICIPANT_FIELDS is None:
+        # PRAGMA table_info returns a list of tuples that looks something like
+        # this:
+        # [(0, 'assists', 'INTEGER', 0, None, 0),
+        #  (1, 'baronKills', 'INTEGER', 0, None, 0),
+        #  (2, 'championId', 'INTEGER', 0, None, 0),
+        #  ... ]
+        # NOTE: Hacky! But allows us to use the schema to *mostly* determine
+        # which fields we want to grab from the JSON.
+        _PARTICIPANT_FIELDS = tuple(sorted(
+            field[1] for field in
+            conn.execute("PRAGMA table_info('Participants')")
+            if field[1] != "matchId"))
+
+        _PARTICIPANT_INSERT_SQL = "INSERT INTO Participants VALUES({})".format(
+            ",".join(["?"] * (len(_PARTICIPANT_FIELDS) + 1)))
+
+        # itemgetter pulls all ~40 values out of the participant dict in one
+        # C-level call instead of a Python loop of dict lookups.
+        _PARTICIPANT_GETTER = operator.itemgetter(*_PARTICIPANT_FIELDS)
+
+    return _PARTICIPANT_FIELDS
+
+
+# Multi-row INSERT ... VALUES (...),(...) statements keyed by row count.
+# Matches always have ten participants, so in practice this holds one entry.
+_PARTICIPANT_BULK_SQL = {}
 
-            conn.commit()
 
-    logging.debug("Processed match data for %s in %f seconds", meta["matchId"],
-        time.time() - now)
+def _participant_bulk_sql(n_rows):
+    sql = _PARTICIPANT_BULK_SQL.get(n_rows)
 
+    if sql is None:
+        placeholders = "({})".format(
+            ",".join(["?"] * (len(_PARTICIPANT_FIELDS) + 1)))
+        sql = "INSERT INTO Participants VALUES {}".format(
+            ",".join([placeholders] * n_rows))
+        _PARTICIPANT_BULK_SQL[n_rows] = sql
 
-def add_player_match_history(conn, name, match_ids, seen_players, seen_matches,
-                             api_key):
+    return sql
+
+
+def process_match(data, conn, cur, seen_masteries, session):
     """
-    Given `seed_player` (a PUUID), gets the most recent 100 matches played by
-    the player, adds the player to `seen_players`, and queues their matches in
-    `match_ids`.
+    Given match data as retrieved by `get_match_by_id()`, extracts relevant data
+    fields and commits them to the database using `conn` (a sqlite3 connection)
+    and `cur`, a long-lived cursor on that connection.
     """
-    logging.info("Adding match history for %s", name)
-    seen_players.add(name)
 
-    try:
-        puuid = get_player_info_by_summoner_name(name, api_key)["puuid"]
-    except SummonerNotFoundException as err:
-        raise err
+    # The timing log below is debug-only; skip both clock reads (and the
+    # format call) entirely when nobody is listening.
+    timing = logging.getLogger().isEnabledFor(logging.DEBUG)
+    now = time.monotonic() if timing else 0.0
 
+    info = data["info"]
+    meta = data["metadata"]
 
-    conn.execute("INSERT INTO SeenPlayers VALUES(?);", [name])
-    conn.commit()
+    _participant_fields(conn)
 
-    match_data = get_matches_by_puuid(puuid, api_key)
+    # Keep the compressed original payload so future schema changes (new
+    # participant columns, team objectives, ...) can be backfilled without
+    # re-fetching every match from the API. Match JSON deflates ~10x.
+    raw = zlib.compress(json.dumps(data, separators=(",", ":")).encode())
 
-    for match in match_data:
-        if match not in seen_matches:
-            match_ids.append(match)
+    rows = [_PARTICIPANT_GETTER(p) + (meta["matchId"],)
+        for p in info["participants"]]
 
+    # Collect mastery rows (and their HTTP fetches) before the transaction
+    # opens so the writer lock is never held across a network round trip.
+    mastery_rows = []
 
-def listen_and_commit(seed_name, seen_players, seen_matches, seen_masteries,
-                      lock, api_key):
-    """
-    Per-thread method that performs a breadth-first search over the player
-    graph. `seen_players` consists of players whose match history has already
-    been fetched, and `seen_matches` consists of matches that have already been
-    processed; both are protected by `lock`.
+    for participant in info["participants"]:
+        # Get each participant's champion mastery info (if we don't have it
+        # already). The set only caches this session's summoners; the
+        # indexed probe covers everything committed by earlier runs.
+        if (participant["summonerName"] not in seen_masteries
+            and conn.execute(
+                "SELECT 1 FROM ChampionMastery WHERE summonerName = ? LIMIT 1",
+                (participant["summonerName"],)).fetchone() is None):
+            mastery_list = get_champion_mastery(participant["summonerId"],
+                session)
 
-    For now, each thread runs until it encounters an exception, after which it
-    will shut down.
-    """
-    last_valid_match = None
+            mastery_rows.extend(
+                (mastery["championId"], mastery["championLevel"],
+                mastery["championPoints"], participant["summonerName"])
+                for mastery in mastery_list)
+            seen_masteries.add(participant["summonerName"])
 
-    conn = sqlite3.connect("league.db", timeout=60)
-    match_ids = collections.deque()
+    # One explicit transaction per match: the match row, its participants,
+    # and any new mastery rows land (or roll back) together, and we pay for
+    # a single commit instead of one per INSERT.
+    cur.execute("BEGIN IMMEDIATE")
 
-    lock.acquire()
-    add_player_match_history(conn, seed_name, match_ids, seen_players,
-        seen_matches, api_key)
-    lock.release()
+    try:
+        cur.execute(_MATCH_INSERT_SQL,
+            (info["gameVersion"], meta["matchId"], info["gameCreation"],
+            info["gameDuration"], info["gameId"],
+            100 if info["teams"][0]["win"] else 200, raw))
 
-    while True:
+        # All rows in one multi-row VALUES statement: one statement
+        # dispatch instead of ten. At 10 rows x ~42 columns we sit well
+        # below SQLite's bound-parameter limit.
+        cur.execute(_participant_bulk_sql(len(rows)),
+            [v for row in rows for v in row])
 
-        try:
-            match = match_ids.popleft()
+        # OR IGNORE + the unique (summonerName, championId) index make mastery
+        # inserts idempotent; seen_masteries stays around purely to avoid
+        # re-fetching masteries over HTTP.
+        cur.executemany(_MASTERY_INSERT_SQL, mastery_rows)
 
-            # NOTE: I'm pretty sure this being necessary is the result of a bug.
-            lock.acquire()
-            if match in seen_matches:
-                lock.release()
-                continue
+        cur.execute("COMMIT")
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
 
-            seen_matches.add(match)
+    if timing:
+        logging.debug("Processed match data for %s in %f seconds",
+            meta["matchId"], time.monotonic() - now)
 
-            num_matches = conn.execute("SELECT COUNT(*) FROM Matches;").fetchone()[0]
 
-            if len(seen_matches) % 100 == 0:
-                logging.info("Processed %d matches (%d committed)",
-                    len(seen_matches), num_matches)
+def add_player_match_history(conn, name, session):
+    """
+    Given a summoner name, gets the most recent 100 matches played by the
+    player, records the player in SeenPlayers, and enqueues their matches in
+    the WorkQueue table. Does nothing if the player was already claimed.
+    """
+    # Claiming the name in SeenPlayers doubles as the dedup check: if the
+    # row already exists (this run or a previous one), someone has fetched
+    # this player's history and there is nothing to do.
+    if conn.execute("INSERT OR IGNORE INTO SeenPlayers VALUES(?);",
+            [name]).rowcount == 0:
+        return
+
+    logging.info("Adding match history for %s", name)
 
-            lock.release()
+    puuid = get_player_info_by_summoner_name(name, session)["puuid"]
 
-            data = get_match_by_match_id(match, api_key)
+    match_data = get_matches_by_puuid(puuid, session)
 
-            if not (data["info"]["gameMode"] == "CLASSIC"
-                and data["info"]["gameType"] == "MATCHED_GAME"
-                and all([p["summonerId"] != "BOT" for p in data["info"]["participants"]])):
-                logging.debug("Match %s gamemode: %s; gametype: %s, skipping",
-                    match, data["info"]["gameMode"], data["info"]["gameType"])
-            else:
-                last_valid_match = data if data else last_valid_match
-                process_match(data, conn, seen_masteries, api_key)
+    # Matches handled in any earlier run are already in SeenMatches; drop
+    # them with one batched primary-key probe (100 IDs, well under SQLite's
+    # parameter limit) so they never churn through the WorkQueue at all.
+    if match_data:
+        seen = {row[0] for row in conn.execute(
+            "SELECT matchId FROM SeenMatches WHERE matchId IN ({})".format(
+                ",".join(["?"] * len(match_data))), match_data)}
+        match_data = [m for m in match_data if m not in seen]
+
+    # Enqueue the whole batch in one explicit transaction; the worker
+    # connection is in autocommit mode, so without BEGIN each row would pay
+    # its own commit.
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(_WQ_ENQUEUE_SQL, ((m,) for m in match_data))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
 
-        except requests.HTTPError as err:
-            traceback.print_exception(type(err), err, err.__traceback__)
-            logging.error("Received some other HTTPError: %s", str(err))
 
-        except requests.ConnectionError as err:
-            traceback.print_exception(type(err), err, err.__traceback__)
-            logging.error("Received a ConnectionError: %s", str(err))
+def listen_and_commit(seed_name, seen_masteries, api_key, stop_event):
+    """
+    Per-thread method that performs a breadth-first search over the player
+    graph. The BFS frontier lives in the WorkQueue table (shared by all
+    threads and resumable across runs) and deduplication of matches and
+    players lives in the SeenMatches and SeenPlayers tables, where the
+    primary keys make claims atomic across threads; `seen_masteries` is only
+    a session-local cache of summoners whose masteries have been fetched.
+
+    Each thread runs until it encounters an exception or `stop_event` is
+    set, after which it will shut down.
+    """
+    last_valid_match = None
 
-        except IndexError as err:
-            traceback.print_exception(type(err), err, err.__traceback__)
+    # isolation_level=None puts the connection in autocommit mode: single
+    # statements (queue claims, probes) commit on their own, and the
+    # multi-statement writes open explicit BEGIN IMMEDIATE transactions, so
+    # there are no surprise implicit BEGIN/COMMIT pairs in between.
+    # tune_connection's busy_timeout makes BEGIN IMMEDIATE wait for the
+    # writer lock rather than raise.
+    conn = tune_connection(sqlite3.connect("league.db", isolation_level=None,
+        cached_statements=256))
 
-            if len(match_ids) == 0:
-                logging.error("Popped from an empty queue. Continuing")
+    # One cursor for the thread's whole lifetime; with the SQL held in
+    # module constants, every statement it runs hits sqlite3's prepared-
+    # statement cache instead of being re-parsed.
+    cur = conn.cursor()
 
-        except KeyError as err:
-            # KeyErrors can (generally) be ignored. If the data does not fit the
-            # format we expect it to fit (i.e. a key is missing), we won't
-            # bother processing it and will skip.
-            traceback.print_exception(type(err), err, err.__traceback__)
-            logging.error("KeyError: %s", str(err))
+    session = make_session(api_key)
+    tid = threading.get_ident()
 
-        except Exception as err:
-            traceback.print_exception(type(err), err, err.__traceback__)
-            logging.error("Some other exception: %s", str(err))
-
-        finally:
-            # Get list of all players in the match and add their recent match
-            # IDs to the queue.
-            if len(match_ids) == 0:
-                lock.acquire()
-                logging.info("Match queue is empty, enqueuing more")
-
-                # It may be the case that `data` is not a valid gamemode or game
-                # type (for example, we could have a custom game with only 1
-                # player). To account for this, we keep track of "valid" matches
-                # in `last_valid_match`, so that when we need to get a valid
-                # player list we have one available.
-                data = last_valid_match
-                for participant in data["info"]["participants"]:
-                    name = participant["summonerName"]
-                    if name not in seen_players:
+    try:
+        add_player_match_history(conn, seed_name, session)
+
+        while not stop_event.is_set():
+            match = None
+
+            try:
+                # Claim one unclaimed frontier match. UPDATE ... RETURNING
+                # marks the row and reads its ID in a single statement, so no
+                # Python-level lock is involved, and autocommit makes the
+                # claim visible to other threads immediately.
+                row = conn.execute(_WQ_CLAIM_SQL,
+                    (tid, int(time.time()))).fetchone()
+
+                if row is None:
+                    # Get list of all players in the last valid match and
+                    # enqueue their recent match IDs.
+                    #
+                    # It may be the case that `data` is not a valid gamemode
+                    # or game type (for example, we could have a custom game
+                    # with only 1 player). To account for this, we keep track
+                    # of "valid" matches in `last_valid_match`, so that when
+                    # we need to get a valid player list we have one
+                    # available.
+                    data = last_valid_match
+
+                    if data is None:
+                        logging.error(
+                            "Queue drained with no valid match to reseed "
+                            "from, shutting down thread")
+                        break
+
+                    logging.info("Match queue is empty, enqueuing more")
+
+                    for participant in data["info"]["participants"]:
+                        name = participant["summonerName"]
                         try:
-                            add_player_match_history(conn, name, match_ids,
-                                seen_players, seen_matches, api_key)
+                            add_player_match_history(conn, name, session)
                         except SummonerNotFoundException as err:
                             traceback.print_exception(type(err), err, err.__traceback__)
                             logging.error("Could not find summoner %s, skipping", str(err))
 
-                logging.info("Added %d new matches to queue", len(match_ids))
-                lock.release()
-
+                    continue
+
+                match = row[0]
+
+                # Record the match as seen. INSERT OR IGNORE either takes
+                # the row or loses the race to another thread/run; the
+                # autocommit write keeps the writer lock short.
+                claimed = conn.execute(
+                    "INSERT OR IGNORE INTO SeenMatches VALUES(?);",
+                    (match,)).rowcount
+
+                if claimed == 0:
+                    continue
+
+                # Databases from before SeenMatches existed only have their
+                # processed matches in Matches, so probe it as well (a
+                # primary-key lookup, so microseconds).
+                if conn.execute("SELECT 1 FROM Matches WHERE matchId = ? LIMIT 1",
+                        (match,)).fetchone() is not None:
+                    continue
+
+                n_seen = next(_progress)
+
+                # COUNT(*) walks the whole table, so only pay for it on the
+                # iterations that actually log.
+                if n_seen % 100 == 0:
+                    num_matches = conn.execute(
+                        "SELECT COUNT(*) FROM Matches;").fetchone()[0]
+                    logging.info("Processed %d matches (%d committed)",
+                        n_seen, num_matches)
+
+                data = get_match_by_match_id(match, session)
+
+                # get_matches_by_puuid only asks for ranked SR games now, so
+                # this can't trip for freshly enqueued IDs -- it guards
+                # against matches queued before the server-side filter
+                # existed (Co-op vs. AI games are CLASSIC/MATCHED_GAME too,
+                # hence the BOT check). The AssertionError lands in the
+                # catch-all handler below and the match is skipped.
+                assert (data["info"]["gameMode"] == "CLASSIC"
+                    and data["info"]["gameType"] == "MATCHED_GAME"
+                    and all(p["summonerId"] != "BOT"
+                        for p in data["info"]["participants"])), \
+                    f"non-SR match {match} in queue"
+
+                last_valid_match = data
+                process_match(data, conn, cur, seen_masteries, session)
+
+            except requests.HTTPError as err:
+                traceback.print_exception(type(err), err, err.__traceback__)
+                logging.error("Received some other HTTPError: %s", str(err))
+
+            except requests.ConnectionError as err:
+                traceback.print_exception(type(err), err, err.__traceback__)
+                logging.error("Received a ConnectionError: %s", str(err))
+
+            except KeyError as err:
+                # KeyErrors can (generally) be ignored. If the data does not fit the
+                # format we expect it to fit (i.e. a key is missing), we won't
+                # bother processing it and will skip.
+                traceback.print_exception(type(err), err, err.__traceback__)
+                logging.error("KeyError: %s", str(err))
+
+            except Exception as err:
+                traceback.print_exception(type(err), err, err.__traceback__)
+                logging.error("Some other exception: %s", str(err))
+
+            finally:
+                # Processed or skipped, a claimed match is done; SeenMatches
+                # is what prevents it from ever being re-fetched.
+                if match is not None:
+                    conn.execute(_WQ_DELETE_SQL, (match,))
+
+    finally:
+        session.close()
 
 def main():
     logging.basicConfig(
@@ -417,32 +761,30 @@ def main():
 
     maybe_init_db_from_schema()
 
-    keys = get_keys_from_file("keys.txt")
+    # Databases created before the per-match index existed pick it up here.
+    reindex()
 
-    # Re-populate seen_players, seen_matches, and seen_masteries if we can
-    conn = sqlite3.connect("league.db")
-
-    seen_players = set([p[0]
-        for p in conn.execute("SELECT summonerName from SeenPlayers;").fetchall()])
+    keys = get_keys_from_file("keys.txt")
 
-    seen_matches = set([m[0]
-        for m in conn.execute("SELECT matchId FROM Matches;").fetchall()])
+    conn = tune_connection(sqlite3.connect("league.db", cached_statements=256))
 
-    seen_masteries = set(m[0]
-        for m in conn.execute("SELECT DISTINCT summonerName from ChampionMastery;").fetchall())
+    # Match/player dedup lives in the SeenMatches/SeenPlayers tables, so the
+    # only shared in-memory state is this session-local cache of summoners
+    # whose masteries have been fetched.
+    seen_masteries = set()
 
-    logging.info("Seen players (match history): %d", len(seen_players))
-    logging.info("Seen matches: %d", len(seen_matches))
-    logging.info("Seen players (mastery): %d", len(seen_masteries))
+    num_committed = conn.execute("SELECT COUNT(*) FROM Matches;").fetchone()[0]
+    logging.info("Matches committed by previous runs: %d", num_committed)
 
-    lock = threading.Lock()
+    # Claims held by threads of a previous (crashed) run are stale now.
+    with conn:
+        conn.execute(
+            "UPDATE WorkQueue SET claimed_by = NULL, claimed_at = NULL;")
 
     if len(keys) == 0:
         logging.error("Could not find any keys!")
         exit(1)
 
-    threads = []
-
     # NOTE: Edit this list! There should be one player for each key in keys.txt.
     players = [
         "Murik",
@@ -454,27 +796,42 @@ def main():
 
     # If this isn't our first time populating this DB, pick a player at random
     # to be the seed player.
-    if len(seen_matches) > 0:
-        pool = [p[0] for p in
-            conn.execute("SELECT DISTINCT summonerName from Participants;").fetchall()]
+    if num_committed > 0:
+        pool = [p[0] for p in conn.execute(
+            """SELECT DISTINCT summonerName FROM Participants
+               WHERE summonerName NOT IN (SELECT summonerName FROM SeenPlayers);""")]
 
         players = random.sample(pool, len(keys))
-        while any([p in seen_players for p in players]):
-            players = random.sample(pool, len(keys))
 
     assert len(players) == len(keys)
 
-    for key, player in zip(keys, players):
-        thread = threading.Thread(target=listen_and_commit,
-            args=(player, seen_players, seen_matches, seen_masteries, lock,
-                  key))
-
-        threads.append(thread)
-        logging.info("Starting thread for key %s", key)
-        thread.start()
-
-    for thread in threads:
-        thread.join()
+    # A pool instead of bare threads so a worker that dies with an exception
+    # surfaces it here (bare Thread targets just print and vanish) and the
+    # run can be torn down as a unit.
+    stop_event = threading.Event()
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(keys)) as executor:
+        futures = []
+
+        for key, player in zip(keys, players):
+            logging.info("Starting worker for key %s", key)
+            futures.append(executor.submit(listen_and_commit, player,
+                seen_masteries, key, stop_event))
+
+        done, _ = concurrent.futures.wait(futures,
+            return_when=concurrent.futures.FIRST_EXCEPTION)
+
+        # Tell the survivors to wind down: leaving the with-block joins
+        # every worker, and without the signal they would keep crawling
+        # forever and main() would never return to the restart loop.
+        stop_event.set()
+
+        for future in done:
+            err = future.exception()
+            if err is not None:
+                logging.error("Worker died with %s: %s",
+                    err.__class__.__qualname__, str(err))
 
 
 if __name__ == "__main__":
@@ -5,24 +5,29 @@ network.
 from tensorflow.keras.models import Sequential
 from tensorflow.keras.layers import Dense
 from model_inputs import match_info_to_nparray
-from db import db_matchinfo_list
+from db import db_matchinfo_iter
 import numpy as np
 import tensorflow as tf
 
 
-matches = db_matchinfo_list(limit=10000)
-print(matches)
-for m in matches:
-    assert len(m.players) == 10
+LIMIT = 10000
 
-converted = [match_info_to_nparray(m) for m in matches]
+# Stream matches straight into preallocated tensors; the MatchInfo objects
+# are never all alive at once.
+x = np.zeros(shape=(LIMIT, 10, 161, 2), dtype=np.float32)
+y = np.zeros(LIMIT, dtype=np.uint8)
 
-x = np.zeros(shape=(len(matches), 10, 161, 2))
+n = 0
 
-for i in range(len(converted)):
-    x[i] = converted[i]
+for i, m in enumerate(db_matchinfo_iter(limit=LIMIT)):
+    assert len(m.players) == 10
+    match_info_to_nparray(m, out=x[i])
+    y[i] = 1 if m.winner == 100 else 0
+    n = i + 1
 
-y = np.array([1 if m.winner == 100 else 0 for m in matches])
+# Fewer valid matches than LIMIT leave a zero tail; trim it.
+x = x[:n]
+y = y[:n]
 print(x.shape)
 print(y.shape)
 model = Sequential()
@@ -13,12 +13,26 @@ POSITION_OFFSET = {
     "UTILITY": 4
 }
 
-def match_info_to_nparray(match_info):
+def match_info_to_nparray(match_info, out=None):
     """
     Returns a mock version of the model's input as a numpy array.
+
+    If `out` is given it must be a (10, 161, 2) float32 array; the result is written
+    into it (and returned) instead of allocating a fresh array, so callers
+    building a big dataset can fill preallocated slices directly.
     """
 
-    model_input = np.zeros(shape=(10, 161, 2))
+    if out is None:
+        # float32 is all TF consumes anyway; float64 just doubles the
+        # dataset's memory and copy bandwidth.
+        model_input = np.zeros(shape=(10, 161, 2), dtype=np.float32)
+    else:
+        model_input = out
+        # Clear the whole buffer: if two players map to the same
+        # team/position slot (possible in legacy non-ranked matches), one
+        # slot is never written and would otherwise keep the previous
+        # match's values.
+        model_input[:] = 0
 
     for p in match_info.players:
         team_offset = 0 if p.team_id == 100 else 5
@@ -26,16 +40,17 @@ def match_info_to_nparray(match_info):
         player_idx = team_offset + pos_offset
 
         player = match_info.players[player_idx]
-        champ_id = player.champion_id
+        masteries = np.asarray(player.masteries)
 
-        # TODO: avoid this for loop, do it in constant time
-        for i in range(len(player.masteries)):
-            if player.masteries[i][0] == champ_id:
-                model_input[player_idx][i][0] = 1
-                break
+        # Column 0 of the masteries array holds champion IDs in ascending
+        # order, so the one-hot index comes from a binary search instead of
+        # a linear scan.
+        i = np.searchsorted(masteries[:, 0], player.champion_id)
+        if i < len(masteries) and masteries[i, 0] == player.champion_id:
+            model_input[player_idx, i, 0] = 1
 
-        for i in range(161):
-            model_input[player_idx][i][1] = player.masteries[i][1]
+        # One C-level copy for the whole mastery column.
+        model_input[player_idx, :, 1] = masteries[:, 1]
 
     return model_input
 
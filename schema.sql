@@ -4,7 +4,10 @@ CREATE TABLE IF NOT EXISTS Matches (
     gameCreation INTEGER,
     gameDuration INTEGER,
     gameId INTEGER,
-    winner INTEGER
+    winner INTEGER,
+    -- zlib-compressed original match JSON, kept so new columns can be
+    -- backfilled without re-fetching from the API.
+    rawJson BLOB
 );
 
 
@@ -13,6 +16,25 @@ CREATE TABLE IF NOT EXISTS SeenPlayers (
 );
 
 
+-- Matches that some ingest thread has already claimed for fetching. The
+-- primary key is what makes claims atomic across threads (INSERT OR IGNORE
+-- either takes the row or loses the race), and unlike Matches this table
+-- also remembers fetched-but-skipped games.
+CREATE TABLE IF NOT EXISTS SeenMatches (
+    matchId TEXT PRIMARY KEY
+);
+
+
+-- The shared BFS frontier. Threads claim rows by writing their thread ID
+-- into claimed_by and delete them once the match is processed, so the
+-- queue survives restarts with no memory footprint.
+CREATE TABLE IF NOT EXISTS WorkQueue (
+    matchId TEXT PRIMARY KEY,
+    claimed_by INTEGER DEFAULT NULL,
+    claimed_at INTEGER DEFAULT NULL
+);
+
+
 CREATE TABLE IF NOT EXISTS Champions (
     armor INTEGER,
     armorperlevel REAL,
@@ -97,5 +119,11 @@ CREATE TABLE IF NOT EXISTS Participants (
     matchId TEXT
 );
 
-CREATE INDEX championMasteryIdx ON ChampionMastery(summonerName, championId);
-CREATE INDEX participantIdx ON Participants(summonerName, matchId);
\ No newline at end of file
+-- Unique so a summoner's masteries can be re-inserted with INSERT OR IGNORE
+-- without creating duplicates.
+CREATE UNIQUE INDEX championMasteryIdx ON ChampionMastery(summonerName, championId);
+CREATE INDEX participantIdx ON Participants(summonerName, matchId);
+
+-- db.py groups participants by match; without this the lookup is a full
+-- table scan per match.
+CREATE INDEX participantMatchIdx ON Participants(matchId);
\ No newline at end of file
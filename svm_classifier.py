@@ -11,15 +11,15 @@ for m in matches:
     assert len(m.players) == 10
 
 
-converted = [match_info_to_nparray(m) for m in matches]
+# Transform straight into preallocated slices; no intermediate
+# per-match arrays.
+x = np.zeros(shape=(len(matches), 10, 161, 2), dtype=np.float32)
 
-x = np.zeros(shape=(len(matches), 10, 161, 2))
-
-for i in range(len(converted)):
-    x[i] = converted[i]
+for i, m in enumerate(matches):
+    match_info_to_nparray(m, out=x[i])
 
 x = x.reshape(len(matches), 161*10*2)
-y = np.array([1 if m.winner == 100 else 0 for m in matches])
+y = np.array([1 if m.winner == 100 else 0 for m in matches], dtype=np.uint8)
 
 X_train, X_test, y_train, y_test = train_test_split(x, y, test_size=0.33, random_state=418)
 